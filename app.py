@@ -1,33 +1,122 @@
 import os
 import logging
+import argparse
 import time
-from openai import OpenAI
+import asyncio
+import random
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, TypeVar
+from collections import OrderedDict, defaultdict
+import aiosqlite
+import httpx
+from openai import AsyncOpenAI, RateLimitError
+from openai.types.beta.threads import Message, Run, TextContentBlock
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # --- Configurazione Iniziale ---
-# Carica le variabili d'ambiente da un file .env se presente (per lo sviluppo locale)
-load_dotenv() 
 
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-ASSISTANT_ID = os.getenv("ASSISTANT_ID")
+logger = logging.getLogger(__name__)
 
-# Controlla che le variabili d'ambiente siano state caricate correttamente
-if not all([TELEGRAM_TOKEN, OPENAI_API_KEY, ASSISTANT_ID]):
-    # Se il codice è in produzione, le variabili devono esistere. Se mancano, il bot si ferma.
-    logging.critical("ERRORE CRITICO: Mancano una o più variabili d'ambiente (TELEGRAM_TOKEN, OPENAI_API_KEY, ASSISTANT_ID)")
-    # Usiamo 'raise' per fermare l'esecuzione se mancano le chiavi
-    raise ValueError("ERRORE CRITICO: Mancano una o più variabili d'ambiente.")
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Configurazione del bot, letta una sola volta dalle variabili d'ambiente all'avvio."""
+    telegram_token: str
+    openai_api_key: str
+    assistant_id: str
+    # URL pubblico HTTPS (es. dietro un reverse proxy) su cui Telegram invia gli aggiornamenti
+    public_url: str | None = None
+    port: int = 8443
+    # Database SQLite in cui vengono salvati i thread degli utenti
+    threads_db: str = "threads.db"
+    threads_retention_days: int = 30
+    # Numero massimo di richieste all'assistente in corso contemporaneamente (in base ai limiti del piano OpenAI)
+    openai_max_inflight: int = 8
 
-# Inizializza il client OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+def carica_config(dev: bool = False) -> Config:
+    """Legge la configurazione dalle variabili d'ambiente (e dal file .env, se presente).
 
-# Dizionario per memorizzare le conversazioni (thread) per ogni utente
-# NOTA: Questo dizionario si resetta ogni volta che il bot si riavvia.
-# Per una soluzione persistente, sarebbe necessario un database.
-user_threads = {}
+    Con 'dev=True' il bot usa il long polling, quindi PUBLIC_URL non è richiesto.
+    """
+    # Carica le variabili d'ambiente da un file .env se presente (per lo sviluppo locale)
+    load_dotenv()
+
+    telegram_token = os.getenv("TELEGRAM_TOKEN")
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    assistant_id = os.getenv("ASSISTANT_ID")
+
+    # Controlla che le variabili d'ambiente siano state caricate correttamente
+    if not telegram_token or not openai_api_key or not assistant_id:
+        # Se il codice è in produzione, le variabili devono esistere. Se mancano, il bot si ferma.
+        logger.critical("ERRORE CRITICO: Mancano una o più variabili d'ambiente (TELEGRAM_TOKEN, OPENAI_API_KEY, ASSISTANT_ID)")
+        # Usiamo 'raise' per fermare l'esecuzione se mancano le chiavi
+        raise ValueError("ERRORE CRITICO: Mancano una o più variabili d'ambiente.")
+
+    # Il webhook ha bisogno dell'URL pubblico su cui Telegram invierà gli aggiornamenti
+    public_url = os.getenv("PUBLIC_URL")
+    if not dev and not public_url:
+        logger.critical("ERRORE CRITICO: Manca la variabile d'ambiente PUBLIC_URL (usa --dev per il long polling)")
+        raise ValueError("ERRORE CRITICO: Manca la variabile d'ambiente PUBLIC_URL.")
+
+    return Config(
+        telegram_token=telegram_token,
+        openai_api_key=openai_api_key,
+        assistant_id=assistant_id,
+        public_url=public_url,
+        port=int(os.getenv("PORT", "8443")),
+        threads_db=os.getenv("THREADS_DB", "threads.db"),
+        threads_retention_days=int(os.getenv("THREADS_RETENTION_DAYS", "30")),
+        openai_max_inflight=int(os.getenv("OPENAI_MAX_INFLIGHT", "8")),
+    )
+
+# Configurazione e client condivisi, inizializzati all'avvio del bot (vedi 'main' e 'apri_risorse')
+config: Config | None = None
+http_client: httpx.AsyncClient | None = None
+client: AsyncOpenAI | None = None
+
+# Cache LRU in memoria delle conversazioni (thread) per ogni utente: chat_id -> (thread_id, updated_at).
+# I thread sono salvati anche su SQLite (scrittura immediata), quindi sopravvivono ai riavvii;
+# la cache evita di interrogare il database a ogni messaggio.
+CACHE_MASSIMA = 10000
+user_threads: OrderedDict[int, tuple[str, int]] = OrderedDict()
+db: aiosqlite.Connection | None = None
+pulizia_task: asyncio.Task[None] | None = None
+
+# Riserva di thread OpenAI già creati e non ancora assegnati: /start e i nuovi utenti
+# ne prendono uno senza aspettare 'threads.create', che viene rifatto in background.
+# La riserva è salvata anche su SQLite, così i thread non assegnati non vanno persi
+# (né ricreati) a ogni riavvio. Quando scende sotto RISERVA_MINIMA viene riempita
+# fino a RISERVA_MASSIMA.
+RISERVA_MASSIMA = 16
+RISERVA_MINIMA = 8
+riserva_threads: asyncio.Queue[str] | None = None
+riserva_task: asyncio.Task[None] | None = None
+
+# Un lock per chat: due primi messaggi simultanei non creano due thread diversi
+thread_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Code dei messaggi in attesa per ogni chat: un worker per chat le consuma in ordine,
+# così l'handler di Telegram ritorna subito e chat diverse procedono in parallelo.
+CODA_MASSIMA = 5
+MessaggioInCoda = tuple[Update, ContextTypes.DEFAULT_TYPE, str]
+code_chat: dict[int, asyncio.Queue[MessaggioInCoda]] = {}
+
+# Buffer dei messaggi inviati in rapida successione: vengono uniti e mandati
+# all'assistente con un'unica run. I testi molto lunghi (vicini al limite di
+# 4096 caratteri di Telegram) sono spesso pezzi di un incolla spezzato, quindi
+# per loro si aspetta di più prima di inviare.
+ATTESA_BUFFER = 0.6
+ATTESA_BUFFER_LUNGO = 2.0
+SOGLIA_TESTO_LUNGO = 4000
+testi_in_attesa: dict[int, list[str]] = {}
+invii_in_attesa: dict[int, asyncio.Task[None]] = {}
+
+# Ultimo messaggio ricevuto da ogni chat (hash del testo, istante di arrivo):
+# un doppio invio accidentale entro pochi secondi non fa partire un'altra run.
+FINESTRA_DUPLICATI = 2.0
+ultimi_messaggi: dict[int, tuple[bytes, float]] = {}
 
 # Configura il logging per mostrare informazioni utili
 logging.basicConfig(
@@ -35,85 +124,487 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# --- Funzioni di Supporto per OpenAI ---
+
+# Ritardi del backoff esponenziale (in secondi) usati per i tentativi dopo un errore 429.
+BACKOFF_INIZIALE = 0.2
+BACKOFF_MASSIMO = 4.0
+TENTATIVI_MASSIMI = 5
+
+# Limita le chiamate a OpenAI in corso (compresi gli stream delle run): gli utenti in
+# eccesso aspettano il proprio turno invece di ricevere errori 429. 'con_retry' occupa
+# un posto solo durante ciascun tentativo, mai durante le attese tra un tentativo e l'altro.
+# Viene creato all'avvio con il limite 'openai_max_inflight' della configurazione.
+openai_sem: asyncio.Semaphore | None = None
+
+def attesa_consigliata(errore: Exception) -> float | None:
+    """Restituisce i secondi indicati dall'header Retry-After di un errore 429, se presente.
+
+    Il valore viene rispettato per intero: riprovare prima finirebbe di nuovo nella
+    finestra del limite e sprecherebbe il tentativo.
+    """
+    if not isinstance(errore, RateLimitError):
+        return None
+    valore = errore.response.headers.get("retry-after")
+    if valore is None:
+        return None
+    try:
+        attesa = float(valore)
+    except ValueError:
+        return None
+    return max(attesa, 0.0)
+
+T = TypeVar("T")
+
+async def con_retry(chiamata: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any) -> T:
+    """Esegue una chiamata all'API di OpenAI ripetendola con backoff e jitter dopo un errore 429.
+
+    Si ripetono solo i 429: OpenAI rifiuta la richiesta prima di elaborarla, quindi
+    anche le scritture (messaggi, run, thread) possono essere ripetute senza duplicarle.
+    Gli errori di connessione non vengono ripetuti, perché la richiesta potrebbe
+    essere già arrivata al server.
+    """
+    assert openai_sem is not None
+    delay = BACKOFF_INIZIALE
+    for tentativo in range(1, TENTATIVI_MASSIMI + 1):
+        try:
+            async with openai_sem:
+                return await chiamata(*args, **kwargs)
+        except RateLimitError as e:
+            if tentativo == TENTATIVI_MASSIMI:
+                raise
+            attesa = attesa_consigliata(e)
+            if attesa is None:
+                attesa = delay + random.uniform(0, delay)
+            logger.warning("Errore temporaneo da OpenAI (%s), nuovo tentativo tra %.2fs", e, attesa)
+            await asyncio.sleep(attesa)
+            delay = min(delay * 2, BACKOFF_MASSIMO)
+    raise AssertionError("non raggiungibile")
+
+def testo_risposta(messaggio: Message) -> str | None:
+    """Restituisce il testo del primo blocco di testo del messaggio, se presente."""
+    for blocco in messaggio.content:
+        if isinstance(blocco, TextContentBlock):
+            return blocco.text.value
+    return None
+
+async def esegui_assistente(thread_id: str) -> tuple[Run, str | None]:
+    """Esegue l'assistente sul thread e restituisce la run conclusa e il testo della risposta."""
+    assert client is not None and config is not None
+    runs = client.beta.threads.runs
+    assistant_id = config.assistant_id
+
+    # Lo streaming chiude il contesto appena il modello ha finito, senza dover
+    # interrogare ripetutamente lo stato della run.
+    async def segui_stream() -> tuple[Run, list[Message]]:
+        async with runs.stream(thread_id=thread_id, assistant_id=assistant_id) as stream:
+            await stream.until_done()
+            return await stream.get_final_run(), await stream.get_final_messages()
+
+    run, final_messages = await con_retry(segui_stream)
+    if run.status != "completed" or not final_messages:
+        return run, None
+    return run, testo_risposta(final_messages[-1])
+
+# --- Memorizzazione dei Thread ---
+
+SECONDI_GIORNO = 24 * 60 * 60
+
+async def apri_risorse(application: Application[Any, Any, Any, Any, Any, Any]) -> None:
+    """Crea i client condivisi, apre il database dei thread e avvia la pulizia periodica dei thread inutilizzati."""
+    global http_client, client, openai_sem, db, pulizia_task, riserva_threads, riserva_task
+    assert config is not None
+
+    # Client HTTP condiviso con HTTP/2 e un pool di connessioni ampio: le chiamate a OpenAI
+    # riusano le stesse connessioni TLS invece di aprirne di nuove durante i picchi.
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+    # Inizializza il client OpenAI asincrono, così le chiamate non bloccano l'event loop.
+    # I tentativi automatici dell'SDK sono disattivati: i 429 vengono ripetuti da 'con_retry',
+    # mentre gli errori di connessione non vanno ripetuti per non duplicare messaggi e run.
+    client = AsyncOpenAI(api_key=config.openai_api_key, http_client=http_client, max_retries=0)
+    openai_sem = asyncio.Semaphore(config.openai_max_inflight)
+
+    db = await aiosqlite.connect(config.threads_db)
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS threads ("
+        "chat_id INTEGER PRIMARY KEY, thread_id TEXT NOT NULL, updated_at INTEGER NOT NULL)"
+    )
+    await db.execute("CREATE TABLE IF NOT EXISTS riserva_threads (thread_id TEXT PRIMARY KEY)")
+    await db.commit()
+    pulizia_task = asyncio.create_task(pulisci_threads())
+
+    # Ricarica i thread della riserva lasciati dall'esecuzione precedente
+    riserva_threads = asyncio.Queue(maxsize=RISERVA_MASSIMA)
+    async with db.execute("SELECT thread_id FROM riserva_threads LIMIT ?", (RISERVA_MASSIMA,)) as cursore:
+        async for (thread_id,) in cursore:
+            riserva_threads.put_nowait(thread_id)
+    riserva_task = asyncio.create_task(riempi_riserva())
+
+async def chiudi_risorse(application: Application[Any, Any, Any, Any, Any, Any]) -> None:
+    """Ferma le attività in background, chiude il database dei thread e il client HTTP condiviso."""
+    for task in (pulizia_task, riserva_task):
+        if task is not None:
+            task.cancel()
+    if db is not None:
+        await db.close()
+    if http_client is not None:
+        await http_client.aclose()
+
+def memorizza_in_cache(chat_id: int, thread_id: str, updated_at: int) -> None:
+    """Aggiorna la cache LRU, scartando la voce usata meno di recente se è piena."""
+    user_threads[chat_id] = (thread_id, updated_at)
+    user_threads.move_to_end(chat_id)
+    if len(user_threads) > CACHE_MASSIMA:
+        vecchio, _ = user_threads.popitem(last=False)
+        rilascia_lock(vecchio)
+
+def rilascia_lock(chat_id: int) -> None:
+    """Elimina il lock della chat uscita dalla cache, se nessuno lo sta usando."""
+    lock = thread_locks.get(chat_id)
+    if lock is not None and not lock.locked():
+        del thread_locks[chat_id]
+
+async def set_thread(chat_id: int, thread_id: str) -> None:
+    """Associa un thread alla chat, salvandolo sia in cache sia sul database."""
+    assert db is not None
+    adesso = int(time.time())
+    await db.execute(
+        "INSERT OR REPLACE INTO threads (chat_id, thread_id, updated_at) VALUES (?, ?, ?)",
+        (chat_id, thread_id, adesso),
+    )
+    await db.commit()
+    memorizza_in_cache(chat_id, thread_id, adesso)
+
+async def get_thread(chat_id: int) -> str | None:
+    """Restituisce il thread della chat (prima dalla cache, poi dal database) o None se non esiste."""
+    assert db is not None
+    voce = user_threads.get(chat_id)
+    if voce is None:
+        async with db.execute("SELECT thread_id, updated_at FROM threads WHERE chat_id = ?", (chat_id,)) as cursore:
+            riga = await cursore.fetchone()
+        if riga is None:
+            return None
+        voce = (riga[0], riga[1])
+    thread_id, updated_at = voce
+
+    # Rinnova la data di utilizzo al massimo una volta al giorno, così le chat
+    # attive non vengono eliminate senza scrivere sul database a ogni messaggio.
+    if time.time() - updated_at > SECONDI_GIORNO:
+        await set_thread(chat_id, thread_id)
+    else:
+        memorizza_in_cache(chat_id, thread_id, updated_at)
+    return thread_id
+
+async def get_or_create_thread(chat_id: int, nuovo: bool = False) -> tuple[str, bool]:
+    """Restituisce (thread_id, creato): il thread esistente della chat oppure uno nuovo.
+
+    Con 'nuovo=True' crea sempre un nuovo thread, sostituendo quello precedente.
+    """
+    assert db is not None and client is not None and riserva_threads is not None
+    async with thread_locks[chat_id]:
+        if not nuovo:
+            thread_id = await get_thread(chat_id)
+            if thread_id is not None:
+                return thread_id, False
+        # Prende un thread dalla riserva o, se è vuota, ne crea uno nuovo su OpenAI
+        try:
+            thread_id = riserva_threads.get_nowait()
+            await db.execute("DELETE FROM riserva_threads WHERE thread_id = ?", (thread_id,))
+        except asyncio.QueueEmpty:
+            thread_id = (await con_retry(client.beta.threads.create)).id
+        await set_thread(chat_id, thread_id)
+        logger.info("Assegnato il thread %s all'utente %s", thread_id, chat_id)
+        return thread_id, True
+
+async def riempi_riserva() -> None:
+    """Quando la riserva scende sotto RISERVA_MINIMA thread, la riempie fino a RISERVA_MASSIMA in background."""
+    assert db is not None and client is not None and riserva_threads is not None
+    while True:
+        if riserva_threads.qsize() >= RISERVA_MINIMA:
+            await asyncio.sleep(5)
+            continue
+        while not riserva_threads.full():
+            try:
+                thread = await con_retry(client.beta.threads.create)
+                await db.execute("INSERT OR IGNORE INTO riserva_threads (thread_id) VALUES (?)", (thread.id,))
+                await db.commit()
+                riserva_threads.put_nowait(thread.id)
+            except Exception as e:
+                logger.warning("Impossibile creare un thread per la riserva: %s", e)
+                await asyncio.sleep(5)
+                break
+
+async def pulisci_threads() -> None:
+    """Elimina periodicamente i thread non usati da più di 'threads_retention_days' giorni."""
+    assert db is not None and config is not None
+    while True:
+        limite = int(time.time()) - config.threads_retention_days * SECONDI_GIORNO
+        try:
+            cursore = await db.execute("DELETE FROM threads WHERE updated_at < ?", (limite,))
+            await db.commit()
+            if cursore.rowcount:
+                logger.info("Eliminati %s thread inutilizzati dal database", cursore.rowcount)
+            for chat_id in [c for c, (_, updated_at) in user_threads.items() if updated_at < limite]:
+                del user_threads[chat_id]
+                rilascia_lock(chat_id)
+        except Exception as e:
+            logger.error("Errore durante la pulizia dei thread: %s", e)
+        await asyncio.sleep(SECONDI_GIORNO)
+
+# --- Funzioni di Supporto per Telegram ---
+
+# Telegram rifiuta i messaggi oltre 4096 caratteri: restiamo un po' sotto il limite.
+LUNGHEZZA_MASSIMA_MESSAGGIO = 4000
+
+def dividi_testo(testo: str, limite: int = LUNGHEZZA_MASSIMA_MESSAGGIO) -> list[str]:
+    """Divide il testo in parti di al massimo 'limite' caratteri, preferendo i confini di paragrafo e di riga."""
+    parti: list[str] = []
+    testo = testo.lstrip("\n")
+    while len(testo) > limite:
+        taglio = testo.rfind("\n\n", 0, limite)
+        if taglio <= 0:
+            taglio = testo.rfind("\n", 0, limite)
+        if taglio <= 0:
+            taglio = limite
+        # Telegram rifiuta i messaggi vuoti: le parti di soli spazi vengono saltate
+        parte = testo[:taglio]
+        if parte.strip():
+            parti.append(parte)
+        testo = testo[taglio:].lstrip("\n")
+    if testo.strip():
+        parti.append(testo)
+    return parti
+
 # --- Funzioni del Bot ---
 
+async def saluta(update: Update) -> None:
+    """Invia il messaggio di benvenuto all'utente."""
+    assert update.message is not None and update.effective_user is not None
+    await update.message.reply_html(
+        f"Ciao {update.effective_user.mention_html()}! 👋\n\nSono pronto a parlare con te. Scrivimi qualcosa.",
+    )
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Gestisce il comando /start, creando un nuovo thread per l'utente."""
-    user = update.effective_user
+    assert update.message is not None and update.effective_chat is not None
     chat_id = update.effective_chat.id
     
     try:
-        # Crea un nuovo thread di conversazione per l'utente su OpenAI
-        thread = client.beta.threads.create()
-        user_threads[chat_id] = thread.id
-        logging.info(f"Creato nuovo thread {thread.id} per l'utente {chat_id}")
-        await update.message.reply_html(
-            f"Ciao {user.mention_html()}! 👋\n\nSono pronto a parlare con te. Scrivimi qualcosa.",
-        )
+        await get_or_create_thread(chat_id, nuovo=True)
+        await saluta(update)
     except Exception as e:
-        logging.error(f"Errore nella creazione del thread per {chat_id}: {e}")
+        logger.error("Errore nella creazione del thread per %s: %s", chat_id, e)
         await update.message.reply_text("Scusa, non riesco a inizializzare la nostra conversazione. Riprova più tardi.")
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Gestisce tutti i messaggi di testo degli utenti."""
+# Telegram mostra l'azione "sta scrivendo" per circa 5 secondi
+INTERVALLO_TYPING = 4
+
+async def mostra_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Invia l'azione 'typing' alla chat ogni INTERVALLO_TYPING secondi finché non viene annullata."""
+    while True:
+        try:
+            await context.bot.send_chat_action(chat_id=chat_id, action='typing')
+        except Exception as e:
+            logger.warning("Impossibile inviare l'azione 'typing' all'utente %s: %s", chat_id, e)
+        await asyncio.sleep(INTERVALLO_TYPING)
+
+async def rispondi(update: Update, context: ContextTypes.DEFAULT_TYPE, user_text: str) -> None:
+    """Invia il messaggio dell'utente all'assistente e risponde con il suo output."""
+    assert update.message is not None and update.effective_chat is not None
+    assert client is not None
     chat_id = update.effective_chat.id
-    user_text = update.message.text
-    
-    # MODIFICA 1: Se l'utente non ha un thread (magari il bot si è riavviato),
-    # esegue la funzione 'start' per crearne uno prima di continuare.
-    if chat_id not in user_threads:
-        logging.warning(f"Thread non trovato per l'utente {chat_id}. Eseguo /start per crearne uno nuovo.")
-        await start(update, context)
-        # Non eseguiamo il resto della funzione, perché il messaggio di benvenuto è già la risposta.
+    # Di norma il thread esiste già (lo crea 'handle_message'), ma la pulizia
+    # periodica potrebbe averlo eliminato nel frattempo.
+    try:
+        thread_id, _ = await get_or_create_thread(chat_id)
+    except Exception as e:
+        logger.error("Errore nella creazione del thread per %s: %s", chat_id, e)
+        await update.message.reply_text("Scusa, non riesco a inizializzare la nostra conversazione. Riprova più tardi.")
         return
-
-    thread_id = user_threads[chat_id]
-    logging.info(f"Messaggio ricevuto nel thread {thread_id} dall'utente {chat_id}: '{user_text}'")
-    await context.bot.send_chat_action(chat_id=chat_id, action='typing')
+    # Il testo può essere lungo: lo si formatta solo se il livello INFO è attivo
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Messaggio ricevuto nel thread %s dall'utente %s: %r", thread_id, chat_id, user_text)
+    # L'indicatore "sta scrivendo" viene inviato in background, senza far aspettare
+    # la chiamata a OpenAI, e ripetuto finché la risposta non è pronta.
+    typing_task = context.application.create_task(mostra_typing(context, chat_id), update=update)
 
     try:
         # 1. Aggiungi il messaggio dell'utente al thread
-        client.beta.threads.messages.create(thread_id=thread_id, role="user", content=user_text)
-
-        # 2. Esegui l'assistente su quel thread
-        run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=ASSISTANT_ID)
+        await con_retry(client.beta.threads.messages.create, thread_id=thread_id, role="user", content=user_text)
 
-        # 3. Aspetta che l'assistente abbia finito di elaborare
-        while run.status in ["queued", "in_progress"]:
-            time.sleep(1) # Riduciamo il polling per essere più gentili con l'API
-            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        # 2. Esegui l'assistente su quel thread e aspetta la risposta
+        run, assistant_response = await esegui_assistente(thread_id)
 
         # Controlla se l'esecuzione è fallita
         if run.status == "failed":
-            logging.error(f"L'esecuzione del thread {thread_id} è fallita: {run.last_error.message}")
+            motivo = run.last_error.message if run.last_error else "motivo sconosciuto"
+            logger.error("L'esecuzione del thread %s è fallita: %s", thread_id, motivo)
             raise Exception("L'assistente non è riuscito a completare la richiesta.")
-        
-        # 4. Recupera i messaggi dal thread
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        
-        # 5. Estrai l'ultima risposta dell'assistente e inviala
-        assistant_response = messages.data[0].content[0].text.value
-        await update.message.reply_text(assistant_response)
+        if assistant_response is None:
+            raise Exception(f"La run del thread {thread_id} si è conclusa con stato '{run.status}'.")
+
+        # 3. Invia la risposta dell'assistente, divisa in più messaggi se troppo lunga.
+        # Le parti vengono inviate una alla volta e non in parallelo (asyncio.gather),
+        # perché Telegram non garantisce l'ordine di arrivo di invii concorrenti.
+        parti = dividi_testo(assistant_response)
+        if not parti:
+            raise Exception(f"La risposta dell'assistente nel thread {thread_id} è vuota.")
+        for parte in parti:
+            await update.message.reply_text(parte, parse_mode=None)
 
     except Exception as e:
-        logging.error(f"Errore durante la gestione del messaggio per il thread {thread_id}: {e}")
+        logger.error("Errore durante la gestione del messaggio per il thread %s: %s", thread_id, e)
         await update.message.reply_text("Ops, qualcosa è andato storto. Ho informato i miei creatori!")
+    finally:
+        typing_task.cancel()
+
+async def worker_chat(chat_id: int, coda: asyncio.Queue[MessaggioInCoda]) -> None:
+    """Consuma in ordine i messaggi in coda per una chat, poi si ferma quando la coda è vuota."""
+    try:
+        while not coda.empty():
+            update, context, user_text = coda.get_nowait()
+            # Un errore su un messaggio non deve fermare il worker: gli altri
+            # resterebbero in una coda ormai abbandonata.
+            try:
+                await rispondi(update, context, user_text)
+            except Exception:
+                logger.exception("Errore non gestito nella risposta all'utente %s", chat_id)
+    finally:
+        # Tra il controllo della coda e la rimozione non ci sono 'await', quindi
+        # nessun nuovo messaggio può finire in una coda ormai abbandonata.
+        if code_chat.get(chat_id) is coda:
+            del code_chat[chat_id]
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Gestisce tutti i messaggi di testo degli utenti."""
+    # Il filtro 'filters.TEXT' garantisce che ci siano una chat e un messaggio di testo
+    assert update.message is not None and update.message.text is not None and update.effective_chat is not None
+    chat_id = update.effective_chat.id
+    user_text = update.message.text
+
+    # Controlli rapidi prima di disturbare OpenAI: messaggi vuoti e duplicati
+    testo = user_text.strip()
+    if not testo:
+        await update.message.reply_text("Scrivimi qualcosa e ti rispondo! 🙂")
+        return
+    impronta = hashlib.blake2b(testo.encode(), digest_size=8).digest()
+    adesso = time.monotonic()
+    # La voce viene tolta e reinserita, così il dizionario resta ordinato per istante
+    # di arrivo e le voci scadute si eliminano partendo dall'inizio.
+    ultimo = ultimi_messaggi.pop(chat_id, None)
+    ultimi_messaggi[chat_id] = (impronta, adesso)
+    # Termina sempre: l'ultima voce è quella appena inserita, che non è scaduta.
+    while True:
+        vecchio = next(iter(ultimi_messaggi))
+        if adesso - ultimi_messaggi[vecchio][1] < FINESTRA_DUPLICATI:
+            break
+        del ultimi_messaggi[vecchio]
+    if ultimo is not None and ultimo[0] == impronta and adesso - ultimo[1] < FINESTRA_DUPLICATI:
+        await update.message.reply_text("Ricevuto! 👍")
+        return
+
+    # MODIFICA 1: Se l'utente non ha un thread (magari è la prima volta che scrive),
+    # ne crea uno e lo saluta come farebbe /start. Il lock per chat garantisce che
+    # un secondo messaggio arrivato nel frattempo usi lo stesso thread.
+    if await get_thread(chat_id) is None:
+        try:
+            _, creato = await get_or_create_thread(chat_id)
+        except Exception as e:
+            logger.error("Errore nella creazione del thread per %s: %s", chat_id, e)
+            await update.message.reply_text("Scusa, non riesco a inizializzare la nostra conversazione. Riprova più tardi.")
+            return
+        if creato:
+            logger.warning("Thread non trovato per l'utente %s. Creato un nuovo thread come con /start.", chat_id)
+            await saluta(update)
+            # Non eseguiamo il resto della funzione, perché il messaggio di benvenuto è già la risposta.
+            return
+
+    # Accumula il testo e rimanda l'invio: se arrivano altri messaggi a breve,
+    # finiscono tutti nella stessa richiesta all'assistente.
+    testi_in_attesa.setdefault(chat_id, []).append(user_text)
+    precedente = invii_in_attesa.get(chat_id)
+    if precedente is not None:
+        precedente.cancel()
+    attesa = ATTESA_BUFFER_LUNGO if len(user_text) >= SOGLIA_TESTO_LUNGO else ATTESA_BUFFER
+    invii_in_attesa[chat_id] = context.application.create_task(svuota_buffer(update, context, attesa), update=update)
+
+async def svuota_buffer(update: Update, context: ContextTypes.DEFAULT_TYPE, attesa: float) -> None:
+    """Dopo l'attesa, unisce i testi accumulati per la chat e li mette in coda come un solo messaggio."""
+    assert update.effective_chat is not None
+    chat_id = update.effective_chat.id
+    await asyncio.sleep(attesa)
+    del invii_in_attesa[chat_id]
+    testi = testi_in_attesa.pop(chat_id)
+    await accoda(update, context, "\n".join(testi))
+
+async def accoda(update: Update, context: ContextTypes.DEFAULT_TYPE, user_text: str) -> None:
+    """Mette il testo nella coda della chat, avviandone il worker se non è già attivo."""
+    assert update.effective_chat is not None
+    chat_id = update.effective_chat.id
+
+    # Il lavoro con OpenAI prosegue in background e l'handler ritorna subito.
+    coda = code_chat.get(chat_id)
+    if coda is None:
+        coda = code_chat[chat_id] = asyncio.Queue(maxsize=CODA_MASSIMA)
+        context.application.create_task(worker_chat(chat_id, coda), update=update)
+
+    scartato = None
+    if coda.full():
+        scartato, _, _ = coda.get_nowait()
+    coda.put_nowait((update, context, user_text))
+
+    if scartato is not None and scartato.message is not None:
+        logger.warning("Coda piena per l'utente %s: scarto il messaggio più vecchio.", chat_id)
+        await scartato.message.reply_text("Mi stai scrivendo troppo in fretta! Ho saltato questo messaggio, riprova tra poco.")
 
 # --- Funzione Principale ---
 
 def main() -> None:
     """Avvia il bot e lo mette in ascolto."""
-    
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    parser = argparse.ArgumentParser(description="Bot Telegram collegato a un assistente OpenAI.")
+    parser.add_argument("--dev", action="store_true", help="usa il long polling invece del webhook (sviluppo locale)")
+    args = parser.parse_args()
+
+    global config
+    config = carica_config(dev=args.dev)
+
+    # 'concurrent_updates(True)' permette di gestire più chat in parallelo:
+    # mentre si aspetta OpenAI per un utente, gli altri non restano bloccati.
+    application = (
+        Application.builder()
+        .token(config.telegram_token)
+        .concurrent_updates(True)
+        .post_init(apri_risorse)
+        .post_shutdown(chiudi_risorse)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    logging.info("Bot avviato con successo! In ascolto...")
-    
+    logger.info("Bot avviato con successo! In ascolto...")
+
     # MODIFICA 2: Aggiunto 'drop_pending_updates=True' per ignorare i vecchi messaggi
     # ricevuti mentre il bot era offline. Molto utile in produzione.
-    application.run_polling(drop_pending_updates=True)
+    if args.dev:
+        application.run_polling(drop_pending_updates=True)
+        return
+
+    # In produzione usiamo un webhook: Telegram ci invia ogni aggiornamento con una
+    # singola POST, senza il ciclo di richieste in attesa del long polling.
+    # 'carica_config' ha già verificato che PUBLIC_URL sia presente
+    assert config.public_url is not None
+    application.run_webhook(
+        listen="0.0.0.0",
+        port=config.port,
+        url_path=config.telegram_token,
+        webhook_url=f"{config.public_url.rstrip('/')}/{config.telegram_token}",
+        drop_pending_updates=True,
+    )
 
 if __name__ == '__main__':
     main()